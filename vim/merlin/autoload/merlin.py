@@ -6,6 +6,16 @@ import os
 import sys
 from sys import platform
 
+# Replies can be large (completion, errors): use a faster decoder when one
+# is available.
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    try:
+        from ujson import loads as json_loads
+    except ImportError:
+        json_loads = json.loads
+
 enclosing_types = [] # nothing to see here
 current_enclosing = -1
 atom_bound = re.compile('[a-z_0-9A-Z\'`.]')
@@ -50,10 +60,10 @@ def try_print_error(e, msg=None):
         if msg: vimprint(msg)
         else:
             msg = str(e)
-            if re.search('Not_found',msg):
+            if 'Not_found' in msg:
                 vimprint("error: Not found")
                 return None
-            elif re.search('Cmi_format.Error', msg):
+            elif 'Cmi_format.Error' in msg:
                 if vim.eval('exists("b:merlin_incompatible_version")') == '0':
                     vim.command('let b:merlin_incompatible_version = 1')
                     vimprint("The version of merlin you're using doesn't support this version of ocaml")
@@ -86,20 +96,31 @@ def concat_map(f, args):
 
 ######## PROCESS MANAGEMENT
 
+def current_filename():
+    # The buffer object already holds the full path, reading it is cheaper
+    # than evaluating expand('%:p').
+    name = vim.current.buffer.name or ""
+    # Like expand(), use forward slashes when 'shellslash' is set on Windows.
+    if platform == "win32" and str(vim.eval("&shellslash")) == "1":
+        name = name.replace("\\", "/")
+    return name
+
 def current_context():
-    filename = vim.eval("expand('%:p')")
-    content = "\n".join(vim.current.buffer) + "\n"
+    filename = current_filename()
+    # Join with a trailing empty line rather than appending "\n" afterwards:
+    # this saves a second copy of the whole buffer.
+    lines = vim.current.buffer[:]
+    lines.append("")
+    content = "\n".join(lines)
     return (filename, content)
 
 last_commands = []
 
 def merlin_exec(args, input=""):
     global last_commands
-    env = os.environ
-    path = vim.eval("merlin#SelectBinary()")
-    if vim.eval("exists('b:merlin_env')") == '1':
-        env = env.copy()
-        newenv = vim.eval("b:merlin_env")
+    path, newenv = vim.eval("[merlin#SelectBinary(), get(b:, 'merlin_env', {})]")
+    if newenv:
+        env = os.environ.copy()
         for key in newenv:
             env[key] = newenv[key]
     else:
@@ -143,6 +164,16 @@ def merlin_exec(args, input=""):
         vimprint("Failed starting ocamlmerlin. Please ensure that ocamlmerlin binary is executable.")
         raise e
 
+def buffer_settings():
+    # Fetch all the settings with a single evaluation rather than one
+    # round-trip to vim per variable.
+    return vim.eval("[g:merlin_debug,"
+                    " get(b:, 'merlin_extensions', []),"
+                    " get(b:, 'merlin_packages_path', []),"
+                    " get(b:, 'merlin_dot_merlins', []),"
+                    " g:merlin_binary_flags,"
+                    " get(b:, 'merlin_flags', [])]")
+
 verbosity_counter = (None,None)
 
 def command2(args, context=None, track_verbosity=None):
@@ -158,19 +189,19 @@ def command2(args, context=None, track_verbosity=None):
     else:
         verbosity = []
     (filename, content) = context or current_context()
-    if vim_is_set("g:merlin_debug"):
+    (debug, extensions, packages_path, dot_merlins, binary_flags, flags) = \
+            buffer_settings()
+    if not (str(debug) in ["", "0", "false"]):
         log_errors = ["-log-file", "-"]
     else:
         log_errors = []
     cmdline = ["server"] + list(args) + ["-filename",filename] + verbosity + \
-            concat_map(lambda ext: ("-extension",ext), vim_list_if_set("b:merlin_extensions")) + \
-            concat_map(lambda pkg: ("-I",pkg), vim_list_if_set("b:merlin_packages_path")) + \
-            concat_map(lambda dm: ("-dot-merlin",dm), vim_list_if_set("b:merlin_dot_merlins")) + \
-            log_errors + \
-            vim.eval('g:merlin_binary_flags') + \
-            vim_list_if_set('b:merlin_flags')
-
-    result = json.loads(merlin_exec(cmdline,input=content))
+            concat_map(lambda ext: ("-extension",ext), extensions) + \
+            concat_map(lambda pkg: ("-I",pkg), packages_path) + \
+            concat_map(lambda dm: ("-dot-merlin",dm), dot_merlins) + \
+            log_errors + binary_flags + flags
+
+    result = json_loads(merlin_exec(cmdline,input=content))
     if result['notifications']:
         notifications = "\n".join(result['notifications'])
         vimprint("(merlin) notifications:\n" + notifications)
@@ -198,9 +229,6 @@ def vim_is_set(name, default=False):
         return default
     return not (vim.eval(name) in ["", "0", "false"])
 
-def vim_list_if_set(name):
-    return vim.eval('exists("{0}") ? {0} : []'.format(name))
-
 def fmtpos(arg):
     if arg is None:
         return "end"
@@ -244,7 +272,7 @@ def command_document(path, pos):
         try_print_error(e)
 
 def differs_from_current_file(path):
-    buf_path = vim.eval("expand('%:p')")
+    buf_path = current_filename()
     return buf_path != path
 
 def vim_fnameescape(s):
@@ -346,18 +374,27 @@ def command_holes():
 ######## VIM FRONTEND
 
 def vim_complete_prepare(str):
-    return re.sub(re_wspaces, " ", str).replace("'", "''").strip()
+    return re_wspaces.sub(" ", str).strip()
 
 def vim_complete_prepare_preserve_newlines(str):
-    return re.sub(re_spaces_around_nl, "\n", re.sub(re_spaces, " ", str)).replace("'", "''").strip()
+    return re_spaces_around_nl.sub("\n", re_spaces.sub(" ", str)).strip()
 
-def vim_fillentries(entries, vimvar):
+def vim_extend_values(vimvar, values):
+    # Append python lists, dicts, strings and numbers to [vimvar] with a
+    # single command: they are converted by the vim module, without being
+    # printed to VimScript, escaped and parsed again.
+    vim.vars['merlin_values'] = values
+    vim.command("call extend(%s, g:merlin_values) | unlet g:merlin_values" % vimvar)
+
+def vim_completion_entries(entries):
     prep = vim_complete_prepare
     prep_nl = vim_complete_prepare_preserve_newlines
-    for prop in entries:
-        vim.command("let tmp = {'word':'%s','menu':'%s','info':'%s','kind':'%s'}" %
-                (prep(prop['name']),prep(prop['desc']),prep_nl(prop['info']),prep(prop['kind'][:1])))
-        vim.command("call add(%s, tmp)" % vimvar)
+    return [{'word': prep(prop['name']), 'menu': prep(prop['desc']),
+             'info': prep_nl(prop['info']), 'kind': prop['kind'][:1]}
+            for prop in entries]
+
+def vim_fillentries(entries, vimvar):
+    vim_extend_values(vimvar, vim_completion_entries(entries))
 
 # Complete
 def vim_complete_cursor(base, suffix, vimvar):
@@ -366,6 +403,7 @@ def vim_complete_cursor(base, suffix, vimvar):
         completions = command_complete_cursor(base,vim.current.window.cursor)
         nb_entries = len(completions['entries'])
         prep = vim_complete_prepare
+        items = []
         if completions['context'] and completions['context'][0] == 'application':
             app = completions['context'][1]
             if not base or base == suffix:
@@ -374,17 +412,16 @@ def vim_complete_cursor(base, suffix, vimvar):
                     if not name.startswith(suffix): name = name.replace("?","~")
                     if name.startswith(suffix):
                         nb_entries = nb_entries + 1
-                        vim.command("let l:tmp = {'word':'%s','menu':'%s','info':'%s','kind':'%s'}" %
-                                (prep(name),prep(label['name'] + ':' + label['type']),'','~'))
-                        vim.command("call add(%s, l:tmp)" % vimvar)
+                        items.append({'word': prep(name), 'info': '', 'kind': '~',
+                                      'menu': prep(label['name'] + ':' + label['type'])})
             show_argtype = vim.eval("g:merlin_completion_argtype")
             if ((show_argtype == 'always' or (show_argtype == 'several' and nb_entries > 1))
                     and (not suffix or atom_bound.match(suffix[0]))
                     and app['argument_type'] != "'_a"):
-                vim.command("let l:tmp = {'word':'%s','abbr':'<type>','kind':':','menu':'%s','empty':1}" %
-                        (prep(suffix),prep(app['argument_type'])))
-                vim.command("call insert(%s, l:tmp)" % vimvar)
-        vim_fillentries(completions['entries'], vimvar)
+                items.insert(0, {'word': prep(suffix), 'abbr': '<type>', 'kind': ':',
+                                 'menu': prep(app['argument_type']), 'empty': 1})
+        items.extend(vim_completion_entries(completions['entries']))
+        vim_extend_values(vimvar, items)
         return (nb_entries > 0)
     except MerlinExc as e:
         try_print_error(e)
@@ -401,9 +438,7 @@ def vim_expand_prefix(base, vimvar, kinds=[]):
         l = l['entries']
         l = map(lambda prop: prop['name'], l)
         l = uniq(sorted(l))
-        for prop in l:
-            name = prop.replace("'", "''")
-            vim.command("call add(%s, '%s')" % (vimvar, name))
+        vim_extend_values(vimvar, l)
     except MerlinExc as e:
         try_print_error(e)
 
@@ -420,20 +455,22 @@ def vim_loclist(vimvar, ignore_warnings):
     vim.command("let %s = []" % vimvar)
     errors = command("errors")
     bufnr = vim.current.buffer.number
+    ignore_warnings = vim.eval(ignore_warnings) == 'true'
     nr = 0
+    items = []
     for error in errors:
         ty = 'E'
         if error['type'] == 'warning':
-            if vim.eval(ignore_warnings) == 'true':
+            if ignore_warnings:
                 continue
             ty = 'W'
-        msg = re.sub(re_wspaces, " ", error['message']).replace("'", "''")
+        msg = re_wspaces.sub(" ", error['message'])
         if msg.startswith("Warning "):
             msg = msg[8:]
         elif msg.startswith("Error: "):
             msg = msg[7:]
         elif msg.startswith("Error (warning"):
-            msg = re.sub(re_error_warning, r"\1: ", msg)
+            msg = re_error_warning.sub(r"\1: ", msg)
         lnum = 1
         col = 1
         if 'start' in error:
@@ -444,10 +481,12 @@ def vim_loclist(vimvar, ignore_warnings):
         if 'end' in error:
             end_lnum = error['end']['line']
             end_col = error['end']['col']
-        vim.command("let l:tmp = {'bufnr':%d,'lnum':%d,'col':%d,'end_lnum':%d,'end_col':%d,'vcol':0,'nr':%d,'pattern':'','text':'%s','type':'%s','valid':1}" %
-                (bufnr, lnum, col, end_lnum, end_col, nr, msg, ty))
+        items.append({'bufnr': bufnr, 'lnum': lnum, 'col': col,
+                      'end_lnum': end_lnum, 'end_col': end_col, 'vcol': 0,
+                      'nr': nr, 'pattern': '', 'text': msg, 'type': ty,
+                      'valid': 1})
         nr = nr + 1
-        vim.command("call add(%s, l:tmp)" % vimvar)
+    vim_extend_values(vimvar, items)
 
 # Locate
 def vim_locate_at_cursor(path):
@@ -485,19 +524,20 @@ def vim_occurrences(vimvar):
     line, col = vim.current.window.cursor
     lst = command_occurrences((line, col))
     lst = map(lambda x: x['start'], lst)
-    bufnr = vim.current.buffer.number
+    buf = vim.current.buffer
+    bufnr = buf.number
     nr = 0
     cursorpos = 0
+    items = []
     for pos in lst:
         lnum = pos['line']
         lcol = pos['col']
         if (lnum, lcol) <= (line, col): cursorpos = nr
-        text = vim.current.buffer[lnum - 1]
-        text = text.replace("'", "''")
-        vim.command("let l:tmp = {'bufnr':%d,'lnum':%d,'col':%d,'vcol':0,'nr':%d,'pattern':'','text':'%s','type':'I','valid':1}" %
-                (bufnr, lnum, lcol + 1, nr, text))
+        items.append({'bufnr': bufnr, 'lnum': lnum, 'col': lcol + 1, 'vcol': 0,
+                      'nr': nr, 'pattern': '', 'text': buf[lnum - 1],
+                      'type': 'I', 'valid': 1})
         nr = nr + 1
-        vim.command("call add(%s, l:tmp)" % vimvar)
+    vim_extend_values(vimvar, items)
     return cursorpos + 1
 
 def vim_occurrences_search():
@@ -554,7 +594,7 @@ def vim_type(expr):
         res = {'type': str(ty), 'matcher': '', 'tail_info':''}
         return json.dumps(res)
     except MerlinExc as e:
-        if re.search('Not_found',str(e)):
+        if 'Not_found' in str(e):
             return '{}'
         else:
             try_print_error(e)
@@ -594,15 +634,12 @@ def replace_buffer_portion(start, end, txt, jump = True):
     prefix = fst_line[0:start['col']]
     suffix = lst_line[end['col']:len(lst_line)]
 
-    del b[start_line:end['line']]
-
     txt = decode(prefix) + txt + decode(suffix)
-    lines = txt.split('\n')
-    lines.reverse()
-    nb_lines = 0
-    for line in lines:
-        nb_lines += 1
-        b[start_line:start_line] = [ encode(line) ]
+    lines = [ encode(line) for line in txt.split('\n') ]
+    nb_lines = len(lines)
+    # Replace the whole range at once, inserting lines one by one shifts the
+    # rest of the buffer for each of them.
+    b[start_line:end['line']] = lines
 
     # Properly reindent the modified lines
     vim.current.window.cursor = (start['line'], 0)
@@ -663,7 +700,7 @@ def vim_type_enclosing():
             atom, start, stop = bounds_of_ocaml_atom_at_pos(to_line - 1, to_col)
             tmp = {'start': {'line':to_line, 'col':start},
                    'end':   {'line':to_line, 'col':stop }}
-            tmp['matcher'] = make_matcher(tmp['start'], tmp['end'])
+            add_highlight(tmp)
             tmp['atom'] = atom
             return json.dumps(tmp)
     except MerlinExc as e:
@@ -739,8 +776,7 @@ def vim_construct(depth):
         vim.current.window.cursor = (loc['start']['line'], loc['start']['col'])
 
         # and write the alternatives in the b:constr_result list:
-        for txt in txts:
-          vim.command("call add(%s, {'word':'%s'})" % (vimvar, txt))
+        vim_extend_values(vimvar, [{'word': txt} for txt in txts])
 
     except MerlinExc as e:
       try_print_error(e)
@@ -755,13 +791,10 @@ def easy_matcher_wide(start, stop):
     return '{0}{1}.*\%{2}l\%{3}c'.format(startl, startc, stop['line'], stop['col'] + 1)
 
 def easy_matcher(start, stop):
-    startl = ""
-    startc = ""
-    if start['line'] > 0:
-        startl = "\%>{0}l".format(start['line'] - 1)
-    if start['col'] > 0:
-        startc = "\%>{0}c".format(start['col'])
-    return '{0}{1}\%<{2}l\%<{3}c'.format(startl, startc, stop['line'] + 1, stop['col'] + 1)
+    return "%s%s\\%%<%dl\\%%<%dc" % (
+            "\\%%>%dl" % (start['line'] - 1) if start['line'] > 0 else "",
+            "\\%%>%dc" % start['col'] if start['col'] > 0 else "",
+            stop['line'] + 1, stop['col'] + 1)
 
 def hard_matcher(start, stop):
     first_start = {'line' : start['line'], 'col' : start['col']}
@@ -773,7 +806,7 @@ def hard_matcher(start, stop):
     last_start = {'line' : stop['line'], 'col' : 0}
     last_stop =  {'line' : stop['line'], 'col' : stop['col']}
     last_line = easy_matcher(last_start, last_stop)
-    return "{0}\|{1}\|{2}".format(first_line, middle, last_line)
+    return "\\|".join((first_line, middle, last_line))
 
 def make_matcher(start, stop):
     if start['line'] == stop['line']:
@@ -781,6 +814,28 @@ def make_matcher(start, stop):
     else:
         return hard_matcher(start, stop)
 
+def make_positions(start, stop):
+    # [line, col, length] triples for matchaddpos(), which highlights
+    # without going through the regex engine. Older vims accept at most 8
+    # positions, larger ranges are left to the matcher.
+    if stop['line'] - start['line'] >= 8:
+        return None
+    if start['line'] == stop['line']:
+        if stop['col'] <= start['col']:
+            return None
+        return [[start['line'], start['col'] + 1, stop['col'] - start['col']]]
+    positions = [[start['line'], start['col'] + 1, 4242]]
+    positions.extend([line] for line in range(start['line'] + 1, stop['line']))
+    if stop['col'] > 0:
+        positions.append([stop['line'], 1, stop['col']])
+    return positions
+
+def add_highlight(record):
+    record['matcher'] = make_matcher(record['start'], record['end'])
+    positions = make_positions(record['start'], record['end'])
+    if positions:
+        record['positions'] = positions
+
 def enclosing_tail_info(record):
     if record['tail'] == 'call': return ' (* tail call *)'
     if record['tail'] == 'position': return ' (* tail position *)'
@@ -820,7 +875,10 @@ def vim_current_enclosing():
     global enclosing_types
     global current_enclosing
     tmp = enclosing_types[current_enclosing]
-    tmp['matcher'] = make_matcher(tmp['start'], tmp['end'])
+    # Growing and shrinking revisit the same entries, only build the
+    # highlight once.
+    if 'matcher' not in tmp:
+        add_highlight(tmp)
 
     enclosing_type_text(tmp)
 
@@ -846,29 +904,37 @@ def vim_prev_enclosing():
     return '{}'
 
 # Finding files
+
+# Answers to path-of-source and list-modules, indexed by directory and by
+# the buffer settings passed to merlin. They are kept until :MerlinReload.
+which_cache = {}
+
+def which_command(*args):
+    settings = [tuple(x) if isinstance(x, list) else x for x in buffer_settings()]
+    key = (os.path.dirname(current_filename()),) + tuple(settings) + args
+    if key not in which_cache:
+        which_cache[key] = command(*args)
+    return which_cache[key]
+
 def vim_which(name,exts):
     if not isinstance(exts, list): exts = [exts]
     files = concat_map(lambda ext: ("-file",name+"."+ext), exts)
-    return command('path-of-source', *files)
+    return which_command('path-of-source', *files)
 
 def vim_which_ext(exts,vimvar):
-    files = command('list-modules', *concat_map(lambda ext: ("-ext",ext), exts))
+    files = which_command('list-modules', *concat_map(lambda ext: ("-ext",ext), exts))
     vim.command("let %s = []" % vimvar)
-    for f in sorted(set(files)):
-        vim.command("call add(%s, '%s')" % (vimvar, f))
+    vim_extend_values(vimvar, sorted(set(files)))
 
 # Options listing
 def vim_flags_list(vimvar):
-    for x in command('flags-list'):
-        vim.command("call add(%s, '%s')" % (vimvar, x))
+    vim_extend_values(vimvar, command('flags-list'))
 
 def vim_extension_list(vimvar):
-    for x in command('extension-list'):
-        vim.command("call add(%s, '%s')" % (vimvar, x))
+    vim_extend_values(vimvar, command('extension-list'))
 
 def vim_findlib_list(vimvar):
-    for x in command('findlib-list'):
-        vim.command("call add(%s, '%s')" % (vimvar, x))
+    vim_extend_values(vimvar, command('findlib-list'))
 
 # Stuff
 
@@ -884,6 +950,14 @@ def setup_merlin():
         fnames = enc(fnames)
         vim.command('let b:dotmerlin=[{0}]'.format(fnames))
 
+def vim_reload():
+    which_cache.clear()
+
+def vim_restart():
+    vim_reload()
+    # Stop the shared server, the next query spawns a fresh one.
+    merlin_exec(["server", "stop-server"])
+
 def vim_last_commands():
     global last_commands
     args = map(lambda x: " ".join(x), last_commands)
@@ -221,7 +221,11 @@ function! s:ShowTypeEnclosing(type)
     return
   endif
 
-  let w:enclosing_zone = matchadd('EnclosingExpr', a:type['matcher'])
+  if has_key(a:type, 'positions') && exists('*matchaddpos')
+    let w:enclosing_zone = matchaddpos('EnclosingExpr', a:type['positions'])
+  else
+    let w:enclosing_zone = matchadd('EnclosingExpr', a:type['matcher'])
+  endif
   augroup MerlinHighlighting
     au!
     autocmd InsertEnter <buffer> call merlin#StopHighlight()
@@ -792,6 +796,7 @@ function! merlin#Register()
   command! -buffer -complete=custom,merlin#CompleteExtensions -nargs=* MerlinExtensions  call merlin#Extensions(<f-args>)
 
   """ .merlin  -----------------------------------------------------------------
+  command! -buffer -nargs=0 MerlinReload call merlin#Reload()
   command! -buffer -nargs=0 GotoDotMerlin call merlin#GotoDotMerlin()
   command! -buffer -nargs=0 EchoDotMerlin call merlin#EchoDotMerlin()
   command! -buffer -nargs=0 MerlinGotoDotMerlin call merlin#GotoDotMerlin()